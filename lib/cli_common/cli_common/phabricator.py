@@ -10,6 +10,7 @@ from urllib.parse import urlencode
 from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
 
 HGMO_JSON_REV_URL_TEMPLATE = 'https://hg.mozilla.org/mozilla-central/json-rev/{}'
 MOZILLA_PHABRICATOR_PROD = 'https://phabricator.services.mozilla.com/api/'
@@ -76,6 +77,12 @@ class PhabricatorAPI(object):
         assert self.url.endswith('/api/'), \
             'Phabricator API must end with /api/'
 
+        # Reuse connections across all requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
         # Test authentication
         self.user = self.request('user.whoami')
         logger.info('Authenticated on {} as {}'.format(self.url, self.user['realName']))
@@ -85,16 +92,18 @@ class PhabricatorAPI(object):
         parts = urlparse(self.url)
         return parts.netloc
 
-    def search_diffs(self, diff_phid=None, revision_phid=None, output_cursor=False, **params):
+    def search_diffs(self, diff_phid=None, revision_phid=None, output_cursor=False, revision_phids=None, **params):
         '''
         Find details of differential diffs from a Differential diff or revision
-        Multiple diffs can be returned (when using revision_phid)
+        Multiple diffs can be returned (when using revision_phid or revision_phids)
         '''
         constraints = {}
         if diff_phid is not None:
             constraints['phids'] = [diff_phid, ]
         if revision_phid is not None:
             constraints['revisionPHIDs'] = [revision_phid, ]
+        if revision_phids is not None:
+            constraints.setdefault('revisionPHIDs', []).extend(revision_phids)
         out = self.request('differential.diff.search', constraints=constraints, **params)
 
         def _clean(diff):
@@ -297,7 +306,7 @@ class PhabricatorAPI(object):
         }
 
         # Run POST request on api
-        response = requests.post(
+        response = self.session.post(
             self.url + path,
             data=urlencode({
                 'params': json.dumps(payload),
@@ -91,6 +91,19 @@ in skipOverrides {
     buildInputs = old.buildInputs ++ [ self."setuptools-scm" ];
   };
 
+  "rs_parsepatch" = self: old: {
+    # Rust extension built with maturin (and a nightly pyo3),
+    # which is not available here: install the prebuilt wheel
+    format = "wheel";
+    src = pkgs.fetchurl {
+      url = "https://files.pythonhosted.org/packages/44/e4/c412e706611d48ade561dcda346a6d9137d47e8f6133648c33399589cb46/rs_parsepatch-0.2.8-cp37-cp37m-manylinux1_x86_64.whl";
+      sha256 = "5b2e2b1801dbda990c1f9790178b9ff12df8ccb3f4cce87bafc1906179f76d17";
+    };
+    # The extension links to libgcc_s
+    nativeBuildInputs = (old.nativeBuildInputs or []) ++ [ pkgs.autoPatchelfHook ];
+    buildInputs = old.buildInputs ++ [ pkgs.stdenv.cc.cc.lib ];
+  };
+
   "scipy" = self: old: {
     prePatch = ''
       rm scipy/linalg/tests/test_lapack.py
@@ -1304,6 +1304,24 @@ let
       };
     };
 
+    "rs_parsepatch" = python.mkDerivation {
+      name = "rs_parsepatch-0.2.8";
+      src = pkgs.fetchurl {
+        url = "https://files.pythonhosted.org/packages/a8/eb/7e9736fb0f5c882b2f06f28e3ad0c8e821c942b9af25aff6655fb4e9d78d/rs_parsepatch-0.2.8.tar.gz";
+        sha256 = "30c4b79cf5ad8141edbbcbc9bcc6b1f8eb21d5602b0b125304d7fb9b08df5cdb";
+      };
+      doCheck = commonDoCheck;
+      checkPhase = "";
+      installCheckPhase = "";
+      buildInputs = commonBuildInputs ++ [ ];
+      propagatedBuildInputs = [ ];
+      meta = with pkgs.stdenv.lib; {
+        homepage = "https://github.com/mozilla/pyo3-parsepatch";
+        license = licenses.mpl20;
+        description = "Library to parse patches in an efficient manner";
+      };
+    };
+
     "s3transfer" = python.mkDerivation {
       name = "s3transfer-0.1.13";
       src = pkgs.fetchurl {
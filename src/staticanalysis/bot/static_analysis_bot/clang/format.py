@@ -64,13 +64,15 @@ class ClangFormat(object):
             for path in filter(settings.is_allowed_path, revision.files)
         ]
         client = hglib.open(settings.repo_dir)
-        self.diff = client.diff(files=allowed_paths, unified=8).decode('utf-8')
+        diff = client.diff(files=allowed_paths, unified=8)
+        self.diff = diff.decode('utf-8')
 
         if not self.diff:
             return []
 
         # Store that diff as an improvement patch sent to devs
-        revision.add_improvement_patch('clang-format', self.diff)
+        # using the raw bytes from mercurial
+        revision.add_improvement_patch('clang-format', diff)
 
         # Generate a reverse diff for `parsepatch` (in order to get original
         # line numbers from the dev's patch instead of new line numbers)
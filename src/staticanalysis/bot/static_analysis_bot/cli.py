@@ -61,6 +61,7 @@ def main(source,
                               'ANALYZERS': ['clang-tidy', ],
                               'PUBLICATION': 'IN_PATCH',
                               'ALLOWED_PATHS': ['*', ],
+                              'PARSEPATCH_FALLBACK': False,
                           },
                           taskcluster_client_id=taskcluster_client_id,
                           taskcluster_access_token=taskcluster_access_token,
@@ -79,6 +80,7 @@ def main(source,
         cache_root,
         secrets['PUBLICATION'],
         secrets['ALLOWED_PATHS'],
+        secrets['PARSEPATCH_FALLBACK'],
     )
 
     # Setup statistics
@@ -42,6 +42,7 @@ class Settings(object):
         self.config = None
         self.app_channel = None
         self.publication = None
+        self.parsepatch_fallback = False
 
         # Paths
         self.cache_root = None
@@ -49,7 +50,7 @@ class Settings(object):
         self.repo_shared_dir = None
         self.taskcluster = None
 
-    def setup(self, app_channel, cache_root, publication, allowed_paths):
+    def setup(self, app_channel, cache_root, publication, allowed_paths, parsepatch_fallback=False):
         self.app_channel = app_channel
         self.download({
             'cpp_extensions': frozenset(['.c', '.h', '.cpp', '.cc', '.cxx', '.hh', '.hpp', '.hxx', '.m', '.mm']),
@@ -58,6 +59,12 @@ class Settings(object):
         assert 'clang_checkers' in self.config
         assert 'target' in self.config
 
+        # Extensions may be overridden by the remote configuration
+        # so they are exposed as tuples of lowercase suffixes for str.endswith
+        for language in ('cpp', 'java'):
+            extensions = self.config['{}_extensions'.format(language)]
+            self.config['{}_ext_suffixes'.format(language)] = tuple(ext.lower() for ext in extensions)
+
         assert isinstance(publication, str)
         try:
             self.publication = Publication[publication]
@@ -82,6 +89,10 @@ class Settings(object):
         assert all(map(lambda p: isinstance(p, str), allowed_paths))
         self.allowed_paths = allowed_paths
 
+        # Use the Python patch parser instead of rs_parsepatch
+        assert isinstance(parsepatch_fallback, bool)
+        self.parsepatch_fallback = parsepatch_fallback
+
     def __getattr__(self, key):
         if key not in self.config:
             raise AttributeError
@@ -3,12 +3,17 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import array
+import bisect
 import io
 import os
-import re
-from collections import OrderedDict
+import weakref
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 
 import hglib
+import rs_parsepatch
 from parsepatch.patch import Patch
 
 from cli_common import log
@@ -20,54 +25,147 @@ from static_analysis_bot.config import settings
 
 logger = log.get_logger(__name__)
 
+PHABRICATOR_DIFF_PREFIX = 'PHID-DIFF-'
+
+# Revisions known to be available, for each Mercurial repo
+_available_revisions = weakref.WeakKeyDictionary()
+
 
 def revision_available(repo, revision):
     '''
     Check a revision is available on a Mercurial repo
+    Only available revisions are cached, as a missing
+    revision may be pulled or imported later on
     '''
+    available = _available_revisions.setdefault(repo, set())
+    if revision in available:
+        return True
+
     try:
         repo.identify(revision)
-        return True
     except hglib.error.CommandError:
         return False
 
+    available.add(revision)
+    return True
+
+
+def build_runs(lines):
+    '''
+    Merge line numbers into sorted half-open runs [start, end)
+    stored as two arrays of starts and ends
+    '''
+    starts, ends = array.array('i'), array.array('i')
+    for line in sorted(lines):
+        if ends and line < ends[-1]:
+            continue
+        if ends and line == ends[-1]:
+            ends[-1] = line + 1
+        else:
+            starts.append(line)
+            ends.append(line + 1)
+    return starts, ends
+
 
 class Revision(object):
     '''
     A common DCM revision
     '''
     def __init__(self):
-        self.files = []
+        self.files = ()
         self.lines = {}
         self.patch = None
+        self.patch_bytes = None
+        self.patch_name = None
         self.improvement_patches = {}
 
+    @property
+    def files(self):
+        '''
+        Files modified by this revision
+        '''
+        return self._files
+
+    @files.setter
+    def files(self, files):
+        '''
+        Store modified files along with their lowercase
+        names, used to detect the analyzers to run
+        '''
+        self._files = tuple(files)
+        self._files_lower = tuple(f.lower() for f in self._files)
+        self._language_flags = None
+
+    @property
+    def patch(self):
+        '''
+        Raw patch of this revision
+        '''
+        return self._patch
+
+    @patch.setter
+    def patch(self, patch):
+        '''
+        Store a new patch, resetting its analysis
+        '''
+        self._patch = patch
+        self._analyzed = False
+        self.lines = {}
+        self.files = ()
+        self._runs = {}
+
     def analyze_patch(self):
         '''
         Analyze loaded patch to extract modified lines
         and statistics
         '''
+        # Skip patch already analyzed
+        if self._analyzed:
+            return
+
         assert self.patch is not None, \
             'Missing patch'
-        assert isinstance(self.patch, str), \
+        assert isinstance(self.patch, (str, bytes)), \
             'Invalid patch type'
 
         # List all modified lines from current revision changes
-        patch = Patch.parse_patch(self.patch, skip_comments=False)
-        assert patch != {}, \
-            'Empty patch'
-        self.lines = {
-            # Use all changes in new files
-            filename: diff.get('touched', []) + diff.get('added', [])
-            for filename, diff in patch.items()
-        }
+        if settings.parsepatch_fallback:
+            # Python parser, kept as a fallback for one release
+            text = self.patch.decode('utf-8') if isinstance(self.patch, bytes) else self.patch
+            patch = Patch.parse_patch(text, skip_comments=False)
+            assert patch != {}, \
+                'Empty patch'
+            self.lines = {
+                # Use all changes in new files
+                filename: frozenset(diff.get('touched', []) + diff.get('added', []))
+                for filename, diff in patch.items()
+            }
+        else:
+            patch = rs_parsepatch.get_lines(self.patch)
+            assert len(patch) > 0, \
+                'Empty patch'
+            self.lines = {
+                # Use all changes in new files
+                diff['filename']: frozenset(diff['added_lines'])
+                for diff in patch
+
+                # Like parsepatch, skip deleted files and changes without
+                # any line (mode changes, renames, modified binary files),
+                # but keep new files, even empty or binary
+                if not diff['deleted'] and (diff['new'] or diff['added_lines'] or diff['deleted_lines'])
+            }
 
         # Shortcut to files modified
-        self.files = self.lines.keys()
+        self.files = tuple(self.lines)
+
+        # Release the patch once parsed, keeping
+        # the current analysis (only patch_bytes is applied)
+        self._patch = None
+        self._analyzed = True
 
         # Report nb of files and lines analyzed
         stats.api.increment('analysis.files', len(self.files))
-        stats.api.increment('analysis.lines', sum(len(line) for line in self.lines.values()))
+        stats.api.increment('analysis.lines', sum(map(len, self.lines.values())))
 
     def contains(self, issue):
         '''
@@ -81,9 +179,35 @@ class Revision(object):
             logger.warn('Issue path in not in revision', path=issue.path, revision=self)
             return False
 
-        # Detect if this issue is in the patch
-        lines = set(range(issue.line, issue.line + issue.nb_lines))
-        return not lines.isdisjoint(modified_lines)
+        # Most issues are on a single line
+        if issue.nb_lines == 1:
+            return issue.line in modified_lines
+
+        # Build sorted runs of modified lines on first use, cached
+        # along with the lines they were built from
+        cached = self._runs.get(issue.path)
+        if cached is None or cached[0] is not modified_lines:
+            cached = self._runs[issue.path] = (modified_lines, build_runs(modified_lines))
+
+        # Detect if this issue is in the patch, using the last run
+        # starting before the end of the issue
+        starts, ends = cached[1]
+        end = issue.line + issue.nb_lines
+        i = bisect.bisect_left(starts, end) - 1
+        return issue.line < end and i >= 0 and ends[i] > issue.line
+
+    @property
+    def language_flags(self):
+        '''
+        Detect languages of modified files, computed
+        once for all the analyzers checks
+        '''
+        if self._language_flags is None:
+            self._language_flags = {
+                'clang': any(f.endswith(settings.cpp_ext_suffixes) for f in self._files_lower),
+                'infer': any(f.endswith(settings.java_ext_suffixes) for f in self._files_lower),
+            }
+        return self._language_flags
 
     @property
     def has_clang_files(self):
@@ -91,11 +215,7 @@ class Revision(object):
         Check if this revision has any file that might
         be a C/C++ file
         '''
-        def _is_clang(filename):
-            _, ext = os.path.splitext(filename)
-            return ext.lower() in settings.cpp_extensions
-
-        return any(_is_clang(f) for f in self.files)
+        return self.language_flags['clang']
 
     @property
     def has_infer_files(self):
@@ -103,24 +223,26 @@ class Revision(object):
         Check if this revision has any file that might
         be a Java file
         '''
-        def _is_infer(filename):
-            _, ext = os.path.splitext(filename)
-            return ext.lower() in settings.java_extensions
-
-        return any(_is_infer(f) for f in self.files)
+        return self.language_flags['infer']
 
     def add_improvement_patch(self, analyzer_name, content):
         '''
         Save an improvement patch, and make it available
         as a Taskcluster artifact
         '''
-        assert isinstance(content, str)
+        assert isinstance(content, (str, bytes))
         assert len(content) > 0
+        assert self.patch_name is not None, \
+            'Missing patch name'
+
+        # Only encode text content, bytes are written as is
+        if isinstance(content, str):
+            content = content.encode('utf-8')
 
         # Build name from analyzer and revision
-        diff_name = '{}-{}.diff'.format(analyzer_name, repr(self))
+        diff_name = '{}-{}.diff'.format(analyzer_name, self.patch_name)
         diff_path = os.path.join(settings.taskcluster.results_dir, diff_name)
-        with open(diff_path, 'w') as f:
+        with open(diff_path, 'wb') as f:
             length = f.write(content)
             logger.info('Improvement patch saved', path=diff_path, length=length)
 
@@ -132,19 +254,18 @@ class PhabricatorRevision(Revision):
     '''
     A phabricator revision to process
     '''
-    regex = re.compile(r'^(PHID-DIFF-(?:\w+))$')
-
     def __init__(self, description, api):
         super().__init__()
         assert isinstance(api, PhabricatorAPI)
         self.api = api
 
         # Parse Diff description
-        match = self.regex.match(description)
-        if match is None:
+        phid_id = description[len(PHABRICATOR_DIFF_PREFIX):]
+        valid_prefix = description.startswith(PHABRICATOR_DIFF_PREFIX)
+        if not valid_prefix or not phid_id.replace('_', '').isalnum():
             raise Exception('Invalid Phabricator description')
-        groups = match.groups()
-        self.diff_phid = groups[0]
+        self.diff_phid = description
+        self.patch_name = self.diff_phid
 
         # Load diff details to get the diff revision
         diffs = self.api.search_diffs(diff_phid=self.diff_phid)
@@ -184,23 +305,28 @@ class PhabricatorRevision(Revision):
         assert isinstance(repo, hglib.client.hgclient)
 
         # Diff PHIDs from our patch to its base
-        patches = OrderedDict()
-        patches[self.diff_phid] = self.diff_id
+        patches = [(self.diff_phid, self.diff_id), ]
 
         parents = self.api.load_parents(self.phid)
         if parents:
 
-            # Load all parent diffs
+            # Load all parent diffs with batched searches
+            diffs, cursor = self.api.search_diffs(revision_phids=parents, output_cursor=True)
+            while cursor['after'] is not None:
+                more_diffs, cursor = self.api.search_diffs(revision_phids=parents, output_cursor=True, after=cursor['after'])
+                diffs += more_diffs
+
+            # Group diffs by their parent revision
+            parents_diffs = defaultdict(list)
+            for diff in diffs:
+                parents_diffs[diff['revisionPHID']].append(diff)
+
             for parent in parents:
                 logger.info('Loading parent diff', phid=parent)
 
-                # Sort parent diffs by their id to load the most recent patch
-                parent_diffs = sorted(
-                    self.api.search_diffs(revision_phid=parent),
-                    key=lambda x: x['id'],
-                )
-                last_diff = parent_diffs[-1]
-                patches[last_diff['phid']] = last_diff['id']
+                # Use the diff with the highest id to load the most recent patch
+                last_diff = max(parents_diffs[parent], key=itemgetter('id'))
+                patches.append((last_diff['phid'], last_diff['id']))
 
                 # Use base revision of last parent
                 hg_base = last_diff['baseRevision']
@@ -214,12 +340,18 @@ class PhabricatorRevision(Revision):
             logger.warning('Missing base revision from Phabricator')
             hg_base = 'central'
 
-        # Load all patches from their numerical ID
-        for diff_phid, diff_id in patches.items():
-            patches[diff_phid] = self.api.load_raw_diff(diff_id)
+        # Load all patches from their numerical ID in parallel,
+        # encoded only once in the workers, as expected by mercurial
+        def _load_patch(diff_id):
+            return self.api.load_raw_diff(diff_id).encode('utf-8')
 
-        # Expose current patch to workflow
-        self.patch = patches[self.diff_phid]
+        diff_phids, diff_ids = zip(*patches)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            patches = list(zip(diff_phids, executor.map(_load_patch, diff_ids)))
+
+        # Expose current (top) patch to workflow, parsed as bytes
+        self.patch_bytes = patches[0][1]
+        self.patch = self.patch_bytes
 
         # Update the repo to base revision
         try:
@@ -233,17 +365,21 @@ class PhabricatorRevision(Revision):
 
         # Apply all patches from base to top
         # except our current (top) patch
-        for diff_phid, patch in reversed(list(patches.items())[1:]):
+        for i in range(len(patches) - 1, 0, -1):
+            diff_phid, patch = patches[i]
             logger.info('Applying parent diff', phid=diff_phid)
             try:
                 repo.import_(
-                    patches=io.BytesIO(patch.encode('utf-8')),
+                    patches=io.BytesIO(patch),
                     message='SA Imported patch {}'.format(diff_phid),
                     user='reviewbot',
                 )
             except hglib.error.CommandError:
                 raise AnalysisException('mercurial', 'Failed to import parent patch {}'.format(diff_phid))
 
+            # Release the parent patch once imported
+            patches[i] = None
+
     def apply(self, repo):
         '''
         Apply patch from Phabricator to Mercurial local repository
@@ -253,7 +389,7 @@ class PhabricatorRevision(Revision):
         # Apply the patch on top of repository
         try:
             repo.import_(
-                patches=io.BytesIO(self.patch.encode('utf-8')),
+                patches=io.BytesIO(self.patch_bytes),
                 message='SA Analyzed patch',
                 user='reviewbot',
             )
@@ -4,10 +4,12 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import itertools
+import json
 import os.path
 import subprocess
 import tempfile
 import time
+import urllib.parse
 from contextlib import contextmanager
 from distutils.spawn import find_executable
 from unittest.mock import Mock
@@ -111,6 +113,34 @@ def mock_issues():
     ]
 
 
+@pytest.fixture
+def mock_issue():
+    '''
+    Build a dummy issue on some lines of a file
+    '''
+    from static_analysis_bot import Issue
+
+    class MockIssue(Issue):
+        def __init__(self, path, line, nb_lines=1):
+            self.path = path
+            self.line = line
+            self.nb_lines = nb_lines
+
+        def as_dict(self):
+            return {}
+
+        def as_markdown(self):
+            return ''
+
+        def as_text(self):
+            return ''
+
+        def validates(self):
+            return True
+
+    return MockIssue
+
+
 @pytest.fixture
 @responses.activate
 @contextmanager
@@ -185,6 +215,79 @@ def mock_phabricator():
     )
 
 
+@pytest.fixture
+@responses.activate
+@contextmanager
+def mock_phabricator_stack():
+    '''
+    Mock phabricator API for a stack of revisions:
+    PHID-DREV-top -> PHID-DREV-parent1 -> PHID-DREV-parent2
+    '''
+    def _response(name):
+        path = os.path.join(MOCK_DIR, 'phabricator_{}.json'.format(name))
+        assert os.path.exists(path)
+        return open(path).read()
+
+    def _params(request):
+        return json.loads(urllib.parse.parse_qs(request.body)['params'][0])
+
+    def _edge_search(request):
+        source = _params(request)['sourcePHIDs'][0]
+        return (200, {}, _response('stack_edge_search_{}'.format(source[len('PHID-DREV-'):])))
+
+    def _diff_search(request):
+        params = _params(request)
+        if 'phids' in params['constraints']:
+            return (200, {}, _response('stack_diff_search'))
+
+        # Parent diffs are listed over 2 pages
+        page = 2 if params.get('after') else 1
+        return (200, {}, _response('stack_diff_search_parents_{}'.format(page)))
+
+    def _raw_diff(request):
+        return (200, {}, _response('stack_diff_raw_{}'.format(_params(request)['diffID'])))
+
+    responses.add(
+        responses.POST,
+        'http://phabricator.test/api/user.whoami',
+        body=_response('auth'),
+        content_type='application/json',
+    )
+
+    responses.add(
+        responses.POST,
+        'http://phabricator.test/api/differential.revision.search',
+        body=_response('revision_search'),
+        content_type='application/json',
+    )
+
+    responses.add_callback(
+        responses.POST,
+        'http://phabricator.test/api/edge.search',
+        callback=_edge_search,
+        content_type='application/json',
+    )
+
+    responses.add_callback(
+        responses.POST,
+        'http://phabricator.test/api/differential.diff.search',
+        callback=_diff_search,
+        content_type='application/json',
+    )
+
+    responses.add_callback(
+        responses.POST,
+        'http://phabricator.test/api/differential.getrawdiff',
+        callback=_raw_diff,
+        content_type='application/json',
+    )
+
+    yield PhabricatorAPI(
+        url='http://phabricator.test/api/',
+        api_key='deadbeef',
+    )
+
+
 @pytest.fixture(scope='session')
 def mock_stats(mock_config):
     '''
@@ -244,6 +347,7 @@ def mock_revision():
     from static_analysis_bot.revisions import Revision
     rev = Revision()
     rev.mercurial = 'a6ce14f59749c3388ffae2459327a323b6179ef0'
+    rev.patch_name = rev.mercurial
     return rev
 
 
@@ -2,7 +2,9 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
+import json
 import os.path
+import urllib.parse
 from unittest.mock import MagicMock
 
 import responses
@@ -23,6 +25,7 @@ def test_phabricator(mock_phabricator, mock_repository, mock_config):
     assert r.diff_phid == 'PHID-DIFF-testABcd12'
     assert r.url == 'https://phabricator.test/D51'
     assert repr(r) == 'PHID-DIFF-testABcd12'
+    assert r.patch_name == 'PHID-DIFF-testABcd12'
     assert r.id == 51  # revision
 
     # Check test.txt content
@@ -35,14 +38,16 @@ def test_phabricator(mock_phabricator, mock_repository, mock_config):
     # Load full patch
     # Mock the mercurial repo update as we use a dummy revision
     assert r.patch is None
+    assert r.patch_bytes is None
     __update = mock_repository.update
     mock_repository.update = MagicMock(return_value=True)
     r.load(mock_repository)
     mock_repository.update = __update
     assert r.patch is not None
-    assert isinstance(r.patch, str)
-    assert len(r.patch.split('\n')) == 7
-    patch = Patch.parse_patch(r.patch)
+    assert isinstance(r.patch, bytes)
+    assert r.patch_bytes is r.patch
+    assert len(r.patch.split(b'\n')) == 7
+    patch = Patch.parse_patch(r.patch.decode('utf-8'))
     assert patch == {
         'test.txt': {
             'touched': [],
@@ -60,11 +65,55 @@ def test_phabricator(mock_phabricator, mock_repository, mock_config):
     assert open(test_txt).read() == 'Hello World\nSecond line\n'
 
 
+@responses.activate
+def test_phabricator_parents(mock_phabricator_stack):
+    '''
+    Test a phabricator revision with a stack of parents
+    '''
+    import hglib
+    from static_analysis_bot.revisions import PhabricatorRevision
+
+    with mock_phabricator_stack as api:
+        r = PhabricatorRevision('PHID-DIFF-top', api)
+
+    repo = MagicMock(spec=hglib.client.hgclient)
+    r.load(repo)
+
+    # Parents diffs are searched in a single batch, over 2 pages
+    searches = [
+        json.loads(urllib.parse.parse_qs(call.request.body)['params'][0])
+        for call in responses.calls
+        if call.request.url.endswith('/differential.diff.search')
+    ]
+    assert [(search['constraints'], search.get('after')) for search in searches] == [
+        ({'phids': ['PHID-DIFF-top']}, None),
+        ({'revisionPHIDs': ['PHID-DREV-parent1', 'PHID-DREV-parent2']}, None),
+        ({'revisionPHIDs': ['PHID-DREV-parent1', 'PHID-DREV-parent2']}, '2'),
+    ]
+
+    # Base revision is the one of the last parent
+    repo.update.assert_called_once_with(rev='base2', clean=True)
+
+    # Most recent diff of each parent is applied, from base to top
+    imports = [
+        (kwargs['message'], kwargs['patches'].getvalue())
+        for _, kwargs in repo.import_.call_args_list
+    ]
+    assert imports == [
+        ('SA Imported patch PHID-DIFF-parent2', b'diff 21\n'),
+        ('SA Imported patch PHID-DIFF-parent1', b'diff 11\n'),
+    ]
+
+    # Top patch is exposed but not applied
+    assert r.patch == b'diff 3\n'
+    assert r.patch_bytes == b'diff 3\n'
+
+
 def test_clang_files(mock_revision):
     '''
     Test clang files detection
     '''
-    assert mock_revision.files == []
+    assert mock_revision.files == ()
     assert not mock_revision.has_clang_files
 
     mock_revision.files = ['test.cpp', 'test.h']
@@ -78,35 +127,25 @@ def test_clang_files(mock_revision):
 
     mock_revision.files = ['test.h', 'test.js', 'xxx.txt']
     assert mock_revision.has_clang_files
+    assert not mock_revision.has_infer_files
 
+    mock_revision.files = ['Test.JAVA', 'test.js']
+    assert not mock_revision.has_clang_files
+    assert mock_revision.has_infer_files
+    assert mock_revision.language_flags == {'clang': False, 'infer': True}
 
-def test_analyze_patch():
-    from static_analysis_bot.revisions import Revision
-    from static_analysis_bot import Issue
-
-    class MyIssue(Issue):
-        def __init__(self, path, line):
-            self.path = path
-            self.line = line
-            self.nb_lines = 1
-
-        def as_dict():
-            return {}
-
-        def as_markdown():
-            return ''
-
-        def as_text():
-            return ''
 
-        def validates():
-            return True
+def test_analyze_patch(mock_issue):
+    '''
+    Test modified lines detection and issues lookup
+    '''
+    from static_analysis_bot.revisions import Revision
 
-    issue_in_new_file = MyIssue('new.txt', 1)
-    issue_in_existing_file_touched_line = MyIssue('modified.txt', 3)
-    issue_in_existing_file_not_changed_line = MyIssue('modified.txt', 1)
-    issue_in_existing_file_added_line = MyIssue('added.txt', 4)
-    issue_in_not_changed_file = MyIssue('notexisting.txt', 1)
+    issue_in_new_file = mock_issue('new.txt', 1)
+    issue_in_existing_file_touched_line = mock_issue('modified.txt', 3)
+    issue_in_existing_file_not_changed_line = mock_issue('modified.txt', 1)
+    issue_in_existing_file_added_line = mock_issue('added.txt', 4)
+    issue_in_not_changed_file = mock_issue('notexisting.txt', 1)
 
     rev = Revision()
     rev.patch = '''
@@ -141,12 +180,13 @@ index 83db48f8..84275f99 100644
 '''
 
     rev.analyze_patch()
+    assert rev.patch is None
     assert 'new.txt' in rev.lines
-    assert rev.lines['new.txt'] == [1, 2, 3]
+    assert rev.lines['new.txt'] == {1, 2, 3}
     assert 'modified.txt' in rev.lines
-    assert rev.lines['modified.txt'] == [3]
+    assert rev.lines['modified.txt'] == {3}
     assert 'added.txt' in rev.lines
-    assert rev.lines['added.txt'] == [4]
+    assert rev.lines['added.txt'] == {4}
     assert 'new.txt' in rev.files
     assert 'modified.txt' in rev.files
     assert 'added.txt' in rev.files
@@ -156,3 +196,215 @@ index 83db48f8..84275f99 100644
     assert not rev.contains(issue_in_existing_file_not_changed_line)
     assert rev.contains(issue_in_existing_file_added_line)
     assert not rev.contains(issue_in_not_changed_file)
+
+    # Issues on multiple lines
+    assert rev.contains(mock_issue('modified.txt', 1, 3))  # overlaps the modified line
+    assert rev.contains(mock_issue('modified.txt', 3, 10))  # starts on the modified line
+    assert rev.contains(mock_issue('new.txt', 3, 5))  # starts on the last added line
+    assert rev.contains(mock_issue('new.txt', 0, 10))  # covers all added lines
+    assert not rev.contains(mock_issue('modified.txt', 1, 2))  # ends right before the modified line
+    assert not rev.contains(mock_issue('modified.txt', 4, 2))  # starts right after the modified line
+    assert not rev.contains(mock_issue('added.txt', 5, 4))  # after the added line
+    assert not rev.contains(mock_issue('added.txt', 1, 3))  # before the added line
+
+    # Issues without any line
+    assert not rev.contains(mock_issue('new.txt', 2, 0))
+    assert not rev.contains(mock_issue('new.txt', 2, -1))
+
+    # Analysis is only run once per patch
+    lines = rev.lines
+    rev.analyze_patch()
+    assert rev.lines is lines
+
+    # Analysis is reset when the patch changes, also parsed from bytes
+    rev.patch = b'''
+diff --git a/other.txt b/other.txt
+new file mode 100644
+index 00000000..83db48f8
+--- /dev/null
++++ b/other.txt
+@@ -0,0 +1,1 @@
++line1
+'''
+    assert rev.lines == {}
+    assert rev.files == ()
+    rev.analyze_patch()
+    assert rev.lines == {'other.txt': {1}}
+    assert rev.files == ('other.txt', )
+
+
+def test_analyze_patch_skipped_files(mock_config, monkeypatch):
+    '''
+    Test deleted files and changes without lines are not analyzed,
+    with both patch parsers
+    '''
+    from static_analysis_bot.revisions import Revision
+
+    patch = '''
+diff --git a/modified.txt b/modified.txt
+index 84275f99..cbc9b72a 100644
+--- a/modified.txt
++++ b/modified.txt
+@@ -1,3 +1,3 @@
+ line1
+-line2
++line7
+ line3
+diff --git a/deleted.cpp b/deleted.cpp
+deleted file mode 100644
+index 83db48f8..00000000
+--- a/deleted.cpp
++++ /dev/null
+@@ -1,2 +0,0 @@
+-line1
+-line2
+diff --git a/script.sh b/script.sh
+old mode 100644
+new mode 100755
+diff --git a/shrinked.txt b/shrinked.txt
+index 84275f99..cbc9b72a 100644
+--- a/shrinked.txt
++++ b/shrinked.txt
+@@ -1,3 +1,2 @@
+ line1
+-line2
+ line3
+diff --git a/pkg/__init__.py b/pkg/__init__.py
+new file mode 100644
+diff --git a/logo.png b/logo.png
+new file mode 100644
+index 0000000000000000000000000000000000000000..cb7a2d2d8b0c27e1c94fcfc1d3e88d4d41a2a15e
+GIT binary patch
+literal 5
+Mc${NkU|?VY00P7SVgLXD
+
+literal 0
+Hc$@<O00001
+
+diff --git a/icon.png b/icon.png
+index 1111111111111111111111111111111111111111..cb7a2d2d8b0c27e1c94fcfc1d3e88d4d41a2a15e 100644
+GIT binary patch
+literal 5
+Mc${NkU|?VY00P7SVgLXD
+
+literal 5
+Mc${NkU|?VY00P7SVgLXD
+
+'''
+    for fallback in (False, True):
+        monkeypatch.setattr(mock_config, 'parsepatch_fallback', fallback)
+
+        rev = Revision()
+        rev.patch = patch
+        rev.analyze_patch()
+        assert rev.lines == {
+            'modified.txt': {2},
+            'shrinked.txt': set(),
+            'pkg/__init__.py': set(),
+            'logo.png': set(),
+        }
+        assert rev.files == ('modified.txt', 'shrinked.txt', 'pkg/__init__.py', 'logo.png')
+        assert not rev.has_clang_files
+
+
+def test_analyze_patch_deleted_files(mock_config):
+    '''
+    Test a patch without any analyzable file is only analyzed once
+    '''
+    from static_analysis_bot.revisions import Revision
+
+    rev = Revision()
+    rev.patch = '''
+diff --git a/deleted.cpp b/deleted.cpp
+deleted file mode 100644
+index 83db48f8..00000000
+--- a/deleted.cpp
++++ /dev/null
+@@ -1,2 +0,0 @@
+-line1
+-line2
+'''
+    rev.analyze_patch()
+    assert rev.lines == {}
+    assert rev.files == ()
+
+    rev.analyze_patch()
+    assert rev.lines == {}
+    assert rev.files == ()
+
+
+def test_contains_updated_lines(mock_issue):
+    '''
+    Test issues are checked against the current modified lines
+    '''
+    from static_analysis_bot.revisions import Revision
+
+    rev = Revision()
+    rev.lines = {'test.cpp': frozenset([1, 2, 3])}
+    assert rev.contains(mock_issue('test.cpp', 2, 3))
+    assert not rev.contains(mock_issue('test.cpp', 10, 3))
+
+    # Lines updated in place
+    rev.lines['test.cpp'] = frozenset([11])
+    assert not rev.contains(mock_issue('test.cpp', 2, 3))
+    assert rev.contains(mock_issue('test.cpp', 10, 3))
+
+    # New file added in place
+    rev.lines['other.cpp'] = frozenset([5, 6])
+    assert rev.contains(mock_issue('other.cpp', 4, 2))
+
+    # All lines replaced
+    rev.lines = {'test.cpp': frozenset([1])}
+    assert rev.contains(mock_issue('test.cpp', 1, 2))
+    assert not rev.contains(mock_issue('test.cpp', 10, 3))
+    assert not rev.contains(mock_issue('other.cpp', 4, 2))
+
+
+def test_build_runs():
+    '''
+    Test modified lines are merged into sorted runs
+    '''
+    from static_analysis_bot.revisions import build_runs
+
+    starts, ends = build_runs({7, 1, 2, 3, 10, 8})
+    assert list(starts) == [1, 7, 10]
+    assert list(ends) == [4, 9, 11]
+
+    starts, ends = build_runs([])
+    assert list(starts) == []
+    assert list(ends) == []
+
+
+def test_revision_available():
+    '''
+    Test only available revisions are cached
+    '''
+    import hglib
+    from static_analysis_bot.revisions import revision_available
+
+    repo = MagicMock()
+    assert revision_available(repo, 'deadbeef')
+    assert revision_available(repo, 'deadbeef')
+    assert repo.identify.call_count == 1
+
+    # Missing revisions are not cached
+    repo.identify.side_effect = hglib.error.CommandError([], 255, b'', b'unknown revision')
+    assert not revision_available(repo, 'missing')
+    assert not revision_available(repo, 'missing')
+    assert repo.identify.call_count == 3
+
+
+def test_improvement_patch(mock_revision, mock_config):
+    '''
+    Test improvement patches are saved from text or bytes
+    '''
+    mock_revision.add_improvement_patch('text', 'Text patch\n')
+    mock_revision.add_improvement_patch('bytes', b'Bytes patch\n')
+    assert set(mock_revision.improvement_patches) == {'text', 'bytes'}
+
+    for analyzer, content in (('text', b'Text patch\n'), ('bytes', b'Bytes patch\n')):
+        path = os.path.join(
+            mock_config.taskcluster.results_dir,
+            '{}-{}.diff'.format(analyzer, mock_revision.patch_name),
+        )
+        assert open(path, 'rb').read() == content